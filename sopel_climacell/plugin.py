@@ -6,7 +6,13 @@ sopel-weather plugin https://github.com/RustyBower/sopel-weather
 """
 from __future__ import unicode_literals, absolute_import, division, print_function
 
-from string import Template
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import re
+import threading
+import time
 
 from sopel.config.types import (
     ListAttribute,
@@ -27,12 +33,60 @@ from sopel.tools.time import (
     validate_timezone
 )
 
-import pendulum
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    from pytz import timezone as ZoneInfo
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+    _json_loads = json.loads
 
 
 LOGGER = tools.get_logger(__name__)
 
+# Shared HTTP session so repeated Google/ClimaCell calls reuse pooled
+# keep-alive connections instead of doing a new TCP+TLS handshake each time
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=2, backoff_factor=0.2),
+))
+_SESSION.headers['User-Agent'] = 'sopel-climacell (https://github.com/cottongin/sopel-climacell)'
+_TIMEOUT = (3.05, 10)
+
+_GEO_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+_TZ_URL = "https://maps.googleapis.com/maps/api/timezone/json"
+_WEATHER_URL = "https://api.climacell.co/v3/weather/realtime"
+
+# Geocoding results barely ever change, so keep an LRU of recent lookups
+_GEO_CACHE = OrderedDict()
+_GEO_CACHE_SIZE = 512
+_GEO_TTL = 86400 * 7
+_GEO_LOCK = threading.Lock()
+
+# Time zones only depend on location (and DST era), keyed on ~1km rounding
+_TZ_CACHE = OrderedDict()
+_TZ_CACHE_SIZE = 512
+_TZ_TTL = 86400
+_TZ_LOCK = threading.Lock()
+
+# The time zone and weather lookups only depend on lat/lon, so run them side
+# by side instead of one after the other
+_POOL = ThreadPoolExecutor(max_workers=4)
+
+_TZ_OBJS = {}
+# Fractional seconds; fromisoformat before 3.11 only takes 3 or 6 digits
+_FRACTION = re.compile(r'\.(\d+)')
+
 
 WEATHER_CODE_DESCRIPTIONS = {
     "rain_heavy":          "🌧️ Substantial rain",
@@ -81,6 +135,7 @@ MAPPED_FIELDS = {
     "moon_phase": bold("Moon P​hase:"),
     "epa_health_concern": bold("Air Quality:"),
 }
+_LABELS = {k: v + " " for k, v in MAPPED_FIELDS.items()}
 
 SORTED_FIELDS = {
     "weather_code": 3,
@@ -104,6 +159,15 @@ SORTED_FIELDS = {
     "moon_phase": 19,
     "epa_health_concern": 20,
 }
+# Small int id per field, in display order, used to index per-field tuples
+_FIELD_NAMES = tuple(sorted(SORTED_FIELDS, key=SORTED_FIELDS.get))
+_FIELD_IDS = {name: fid for fid, name in enumerate(_FIELD_NAMES)}
+# Fields the plugin has no metadata for sort last and are shown unlabelled
+_UNKNOWN_FIELD_ID = len(_FIELD_NAMES)
+_META_KEYS = frozenset({"lat", "lon", "observation_time"})
+
+# The only fields ClimaCell reports in F/C
+_TEMP_FIELDS = frozenset({"temp", "feels_like", "dewpoint"})
 
 
 class ClimacellSection(StaticSection):
@@ -153,6 +217,11 @@ def setup(bot):
     bot.config.define_section('climacell', ClimacellSection)
 
 
+def shutdown(bot):
+    _POOL.shutdown(wait=False)
+    _SESSION.close()
+
+
 @commands('weather', 'wz')
 @example('.weather boston')
 def weather(bot, trigger):
@@ -186,10 +255,10 @@ def weather(bot, trigger):
 
     api_key = bot.config.climacell.climacell_api_key
 
-    channel_or_nick = tools.Identifier(trigger.nick)
-    zone = _get_timezone(
+    fut_tz = _POOL.submit(
+        _get_timezone,
         latitude, longitude, 
-        pendulum.now().int_timestamp,
+        int(time.time()),
         bot.config.climacell.google_api_key
     )
 
@@ -200,11 +269,12 @@ def weather(bot, trigger):
         'api_key': api_key,
         'fields': ",".join(bot.config.climacell.now_info_items),
         'units': bot.config.climacell.units,
-        'tz': zone
     }
+    fut_wx = _POOL.submit(_fetch_weather_json, bundle)
 
-    reply = get_weather(bundle)
-    if len(repr(reply)) > 475:
+    reply = _format_weather(fut_wx.result(), location, fut_tz.result())
+    # Sopel has roughly 400 bytes of room for text in a single PRIVMSG line
+    if len(reply.encode('utf-8')) > 400:
         reply = reply.split(' | ')
         div = int(len(reply) / 2)
         bot.say(' | '.join(reply[:div]))
@@ -255,53 +325,67 @@ def set_location(bot, trigger):
 
 def get_latlon(user_location, api_key):
     """Gets latitude and longitude for a location"""
-    url = "https://maps.googleapis.com/maps/api/geocode/json?address={user_location}&key={api_key}"
-    lat = lon = loc = None
-    
+    cache_key = user_location.strip().lower()
+    with _GEO_LOCK:
+        cached = _GEO_CACHE.get(cache_key)
+        if cached and time.time() - cached[0] < _GEO_TTL:
+            _GEO_CACHE.move_to_end(cache_key)
+            return cached[1]
+
     try:
-        data = requests.get(url.format(
-            user_location = user_location,
-            api_key = api_key
-        ))
+        data = _SESSION.get(_GEO_URL, params={
+            'address': user_location,
+            'key': api_key,
+        }, timeout=_TIMEOUT)
         LOGGER.debug(data.url)
-        data = data.json()
+        data = _json_loads(data.content)
+    except (requests.RequestException, ValueError) as e:
+        # the exception text can include the request URL, API key and all
+        LOGGER.warning("Geocoding request failed: %s", type(e).__name__)
+        return None, None, None
 
+    try:
         data = data['results'][0]
 
         loc = data['formatted_address']
         lat = data['geometry']['location']['lat']
         lon = data['geometry']['location']['lng']
-    except:
-        pass
+    except (KeyError, IndexError):
+        return None, None, None
 
-    return lat, lon, loc
+    with _GEO_LOCK:
+        _GEO_CACHE[cache_key] = (time.time(), (lat, lon, loc))
+        _GEO_CACHE.move_to_end(cache_key)
+        while len(_GEO_CACHE) > _GEO_CACHE_SIZE:
+            _GEO_CACHE.popitem(last=False)
 
+    return lat, lon, loc
 
-def get_weather(bundle):
-    """Gets weather for a user or location"""
-    url = ("https://api.climacell.co/v3/weather/realtime?lat={lat}&lon={lon}"
-           "&fields={fields}&unit_system={units}&apikey={api_key}").format(
-               lat = bundle['latitude'],
-               lon = bundle['longitude'],
-               fields = bundle['fields'],
-               units = bundle['units'],
-               api_key = bundle['api_key']
-           )
 
-    data = requests.get(url)
+def _fetch_weather_json(bundle):
+    """Fetches realtime weather data for a location"""
+    data = _SESSION.get(_WEATHER_URL, params={
+        'lat': bundle['latitude'],
+        'lon': bundle['longitude'],
+        'fields': bundle['fields'],
+        'unit_system': bundle['units'],
+        'apikey': bundle['api_key'],
+    }, timeout=_TIMEOUT)
     LOGGER.debug(data.url)
-    data = data.json()
-
-    sort_keys = {}
-    for k in data:
-        if SORTED_FIELDS.get(k):
-            sort_keys[k] = SORTED_FIELDS.get(k)
-        else:
-            sort_keys[k] = 999
-    sorted_dict = {k: data[k] for k in sorted(data, key=lambda x: sort_keys[x])}
-    parsed_fields = _parse_data(sorted_dict, bundle['tz'])
-
-    location = bold("[{}]".format(bundle['location']))
+    return _json_loads(data.content)
+
+
+def _format_weather(data, location, timezone):
+    """Formats realtime weather data for a location"""
+    fields = []
+    for key, values in data.items():
+        if key in _META_KEYS:
+            continue
+        fields.append((_FIELD_IDS.get(key, _UNKNOWN_FIELD_ID), values))
+    fields.sort(key=lambda field: field[0])
+    parsed_fields = _parse_data(fields, timezone)
+
+    location = bold("[{}]".format(location))
     base_string = "{} {} | Powered by ClimaCell API (https://www.climacell.co/weather-api)".format(
         location,
         parsed_fields
@@ -311,160 +395,187 @@ def get_weather(bundle):
 
 
 def _parse_data(data, timezone):
-    """parse data"""
+    """parse sorted (field id, value) pairs of data"""
     
-    string = ""
-    idx = 0
-    for key,values in data.items():
-        value_map = values
-        if idx == 0:
-            prefix = ""
-        else:
-            prefix = " | "
-
-        if key in ["lat", "lon", "observation_time"]:
-            continue
-        if not value_map.get('value') or value_map.get('value') == 'none':
+    parts = []
+    for fid,values in data:
+        if not values.get('value') or values.get('value') == 'none':
             continue
 
-        if key == "weather_code":
-            value_map = {'value': WEATHER_CODE_DESCRIPTIONS[values['value']]}
-
-        if value_map.get('units'):
-            if value_map['units'] == "F":
-                f_color = _get_temp_color(value_map['value'])
-                value_map = {
-                    'value': "{}°F/{}°C".format(
-                        color("{}".format(round(value_map['value'])), f_color),
-                        color("{}".format(round(f_to_c(value_map['value']), 1)), f_color),
-                    )
-                }
-            elif value_map['units'] == "C":
-                f_color = _get_temp_color(c_to_f(value_map['value']))
-                value_map = {
-                    'value': "{}°C/{}°F".format(
-                        color("{}".format(round(value_map['value'], 1)), f_color),
-                        color("{}".format(round(c_to_f(value_map['value']))), f_color),
-                    )
-                }
-
-        if key == "wind_direction":
-            value_map = {'value': get_wind(values['value'])}
-
-        if key in ["sunrise", "sunset"]:
-            value_map = {'value': _parse_time(values['value'], timezone)}
-        
+        parts.append(_FIELD_FORMATTERS[fid](values, timezone))
+
+    return ' | '.join(parts)
+
+
+MOON_PHASES = {
+    "new": "🌑 new moon",
+    "new_moon": "🌑 new moon",
+    "waxing_crescent": "🌒 waxing crescent (1/4 full)",
+    "first_quarter": "🌓 half moon (first quarter)",
+    "waxing_gibbous": "🌔 waxing gibbous (3/4 full)",
+    "full": "🌕 full moon",
+    "waning_gibbous": "🌖 waning gibbous (3/4 full)",
+    "third_quarter": "🌗 half moon (last quarter)",
+    "last_quarter": "🌗 half moon (last quarter)",
+    "waning_crescent": "🌘 waning crescent (1/4 full)"
+}
+
+
+def _round_int(value):
+    return "{}".format(round(value))
+
+
+def _round_decimal(value):
+    return "{:.2f}".format(round(value, 2))
+
+
+VALUE_FORMATS = {
+    "humidity": _round_int,
+    "baro_pressure": _round_decimal,
+    "wind_speed": _round_int,
+    "wind_gust": _round_int,
+    "moon_phase": MOON_PHASES.__getitem__,
+    "visibility": _round_int,
+    "surface_shortwave_radiation": _round_int
+}
+
+
+def _format_temp(values):
+    """format a temperature in both F and C, leading with the API's unit"""
+    value = values['value']
+    units = values.get('units')
+    is_f = units == "F"
+    if not is_f and units != "C":
+        return "{}{}".format(value, units or '')
+    if is_f:
+        temp_f, temp_c = value, f_to_c(value)
+    else:
+        temp_f, temp_c = c_to_f(value), value
+    f_color = _get_temp_color(temp_f)
+    temp_f = color("{}".format(round(temp_f)), f_color) + "°F"
+    temp_c = color("{:.1f}".format(temp_c), f_color) + "°C"
+    if is_f:
+        return temp_f + "/" + temp_c
+    return temp_c + "/" + temp_f
+
+
+def _value_formatter(label, value_format):
+    """build a formatter for a plain value with optional units"""
+    def formatter(values, timezone):
+        value = values['value']
         try:
-            value_map['value'] = _get_value_format(value_map['value'], key)
-        except:
+            value = value_format(value)
+        except (TypeError, ValueError, KeyError):
             pass
+        return "{}{}{}".format(label, value, values.get('units') or '')
+    return formatter
 
-        template = Template("{pfx}{field} $value$units").safe_substitute(value_map)
-        string += template.format(
-            pfx=prefix,
-            field=MAPPED_FIELDS.get(key, ""),
-        )
-        idx += 1
 
-    return string.replace('$units', '')
+def _temp_formatter(label):
+    """build a formatter for the temperature fields"""
+    def formatter(values, timezone):
+        return label + _format_temp(values)
+    return formatter
 
 
-def _get_value_format(value, field):
-    """get value format by field"""
-    
-    def moonphases():
-        moon_phases = {
-            "new": "🌑 new moon", 
-            "new_moon": "🌑 new moon", 
-            "waxing_crescent": "🌒 waxing crescent (1/4 full)", 
-            "first_quarter": "🌓 half moon (first quarter)", 
-            "waxing_gibbous": "🌔 waxing gibbous (3/4 full)", 
-            "full": "🌕 full moon", 
-            "waning_gibbous": "🌖 waning gibbous (3/4 full)", 
-            "third_quarter": "🌗 half moon (last quarter)", 
-            "last_quarter": "🌗 half moon (last quarter)", 
-            "waning_crescent": "🌘 waning crescent (1/4 full)"
-        }
-        return moon_phases[value]
-
-    def round_int():
-        return "{}".format(round(value))
-
-    def round_decimal():
-        return "{:.2f}".format(round(value, 2))
-
-    def stringify():
-        return "{}".format(value)
-
-    formats = {
-        "humidity": round_int,
-        "baro_pressure": round_decimal,
-        "wind_speed": round_int,
-        "wind_gust": round_int,
-        "moon_phase": moonphases,
-        "visibility": round_int,
-        "surface_shortwave_radiation": round_int
-    }
+def _weather_code_formatter(label):
+    """build a formatter for the weather_code field"""
+    def formatter(values, timezone):
+        return label + WEATHER_CODE_DESCRIPTIONS[values['value']]
+    return formatter
+
 
-    func = formats.get(field) or stringify
-    return func()
+def _wind_formatter(label):
+    """build a formatter for the wind_direction field"""
+    def formatter(values, timezone):
+        return label + get_wind(values['value'])
+    return formatter
+
+
+def _time_formatter(label):
+    """build a formatter for the sunrise/sunset fields"""
+    def formatter(values, timezone):
+        try:
+            return label + _parse_time(values['value'], timezone)
+        except (AttributeError, TypeError, ValueError):
+            return label + "{}".format(values['value'])
+    return formatter
+
+
+def _build_formatter(key):
+    """build the formatter for a field, bound to its label"""
+    label = _LABELS.get(key, "")
+    if key in _TEMP_FIELDS:
+        return _temp_formatter(label)
+    if key == "weather_code":
+        return _weather_code_formatter(label)
+    if key == "wind_direction":
+        return _wind_formatter(label)
+    if key in ["sunrise", "sunset"]:
+        return _time_formatter(label)
+    return _value_formatter(label, VALUE_FORMATS.get(key, "{}".format))
+
+
+_FIELD_FORMATTERS = tuple(_build_formatter(key) for key in _FIELD_NAMES) + (
+    _build_formatter(None),
+)
+
+
+_WIND_DIRECTIONS = (
+    u'\u2193 N', u'\u2199 NE', u'\u2190 E', u'\u2196 SE',
+    u'\u2191 S', u'\u2197 SW', u'\u2192 W', u'\u2198 NW',
+)
 
 
 def get_wind(bearing):
     """get wind direction"""
+    return _WIND_DIRECTIONS[int((bearing + 22.5) % 360) // 45]
 
-    if (bearing <= 22.5) or (bearing > 337.5):
-        bearing = u'\u2193 N'
-    elif (bearing > 22.5) and (bearing <= 67.5):
-        bearing = u'\u2199 NE'
-    elif (bearing > 67.5) and (bearing <= 112.5):
-        bearing = u'\u2190 E'
-    elif (bearing > 112.5) and (bearing <= 157.5):
-        bearing = u'\u2196 SE'
-    elif (bearing > 157.5) and (bearing <= 202.5):
-        bearing = u'\u2191 S'
-    elif (bearing > 202.5) and (bearing <= 247.5):
-        bearing = u'\u2197 SW'
-    elif (bearing > 247.5) and (bearing <= 292.5):
-        bearing = u'\u2192 W'
-    elif (bearing > 292.5) and (bearing <= 337.5):
-        bearing = u'\u2198 NW'
-
-    return bearing
+
+_TEMP_BOUNDS = (10, 32, 50, 60, 70, 80, 90)
+_TEMP_COLORS = (
+    colors.LIGHT_BLUE, colors.TEAL, colors.BLUE, colors.LIGHT_GREEN,
+    colors.GREEN, colors.YELLOW, colors.ORANGE, colors.RED,
+)
 
 
 def _get_temp_color(f):
     """get color"""
-    if f < 10:
-        color = colors.LIGHT_BLUE
-    elif f < 32:
-        color = colors.TEAL
-    elif f < 50:
-        color = colors.BLUE
-    elif f < 60:
-        color = colors.LIGHT_GREEN
-    elif f < 70:
-        color = colors.GREEN
-    elif f < 80:
-        color = colors.YELLOW
-    elif f < 90:
-        color = colors.ORANGE
-    else:
-        color = colors.RED
-    return color
+    return _TEMP_COLORS[bisect_right(_TEMP_BOUNDS, f)]
 
 
-def _parse_time(time, tz):
+def _parse_time(value, tz):
     """parse time"""
-    return pendulum.parse(time, strict=False).in_tz(tz).format("h:mm A zz")
+    zone = _TZ_OBJS.get(tz)
+    if zone is None:
+        zone = _TZ_OBJS[tz] = ZoneInfo(tz)
+    value = _FRACTION.sub(
+        lambda m: '.' + m.group(1)[:6].ljust(6, '0'),
+        value.replace('Z', '+00:00'),
+    )
+    parsed = datetime.fromisoformat(value).astimezone(zone)
+    return parsed.strftime("%I:%M %p %Z").lstrip('0')
 
 
 def _get_timezone(lat, lng, now, key):
     """get timezone"""
-    url = ("https://maps.googleapis.com/maps/api/timezone/json"
-           "?location={lat},{lng}"
-           "&timestamp={now}"
-           "&key={key}").format(lat=lat,lng=lng,now=now,key=key)
-    data = requests.get(url).json()
-
-    return data['timeZoneId']
\ No newline at end of file
+    cache_key = (round(lat, 2), round(lng, 2))
+    with _TZ_LOCK:
+        cached = _TZ_CACHE.get(cache_key)
+        if cached and time.time() - cached[0] < _TZ_TTL:
+            _TZ_CACHE.move_to_end(cache_key)
+            return cached[1]
+
+    data = _json_loads(_SESSION.get(_TZ_URL, params={
+        'location': "{},{}".format(lat, lng),
+        'timestamp': now,
+        'key': key,
+    }, timeout=_TIMEOUT).content)
+
+    zone = data['timeZoneId']
+    with _TZ_LOCK:
+        _TZ_CACHE[cache_key] = (time.time(), zone)
+        _TZ_CACHE.move_to_end(cache_key)
+        while len(_TZ_CACHE) > _TZ_CACHE_SIZE:
+            _TZ_CACHE.popitem(last=False)
+    return zone